@@ -5,12 +5,16 @@ from docx import Document
 import google.generativeai as genai
 import io
 import time
+import random
+import threading
 import zipfile
 import json
 import re
 import sqlite3
 import hashlib
 from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from fpdf import FPDF
 import plotly.express as px
 
@@ -59,6 +63,64 @@ def get_available_models(api_key):
     except:
         return ["gemini-1.5-flash"]
 
+class RateLimiter:
+    """Token bucket doble (solicitudes/min y tokens/min) compartido por los hilos de análisis.
+    Ante un 429/cuota agotada bloquea a todos los hilos con backoff exponencial y reduce
+    el ritmo efectivo (AIMD); cada respuesta exitosa lo recupera gradualmente."""
+
+    def __init__(self, rpm, tpm):
+        self.rpm, self.tpm = float(rpm), float(tpm)
+        self.req_bucket, self.tok_bucket = self.rpm, self.tpm
+        self.factor = 1.0          # Fracción del ritmo nominal (baja ante 429)
+        self.backoff = 0.0         # Segundos de la última penalización
+        self.blocked_until = 0.0
+        self.last = time.monotonic()
+        self.cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self.last = now - self.last, now
+        self.req_bucket = min(self.rpm, self.req_bucket + elapsed * self.rpm * self.factor / 60)
+        self.tok_bucket = min(self.tpm, self.tok_bucket + elapsed * self.tpm * self.factor / 60)
+        return now
+
+    def acquire(self, tokens=0):
+        tokens = min(tokens, self.tpm)
+        with self.cond:
+            while True:
+                now = self._refill()
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    wait = max((1 - self.req_bucket) * 60 / (self.rpm * self.factor),
+                               (tokens - self.tok_bucket) * 60 / (self.tpm * self.factor), 0)
+                    if wait == 0:
+                        self.req_bucket -= 1
+                        self.tok_bucket -= tokens
+                        return
+                self.cond.wait(wait)
+
+    def on_success(self):
+        with self.cond:
+            self.backoff = 0.0
+            self.factor = min(1.0, self.factor + 0.05)
+
+    def on_throttle(self):
+        with self.cond:
+            self.backoff = min(max(self.backoff * 2, 2.0), 60.0)
+            self.factor = max(0.1, self.factor * 0.5)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + self.backoff + random.uniform(0, 1))
+            self.req_bucket = 0.0
+            self.cond.notify_all()
+
+@st.cache_resource
+def get_rate_limiter(api_key, rpm, tpm):
+    # Un limitador por API Key y proceso: todas las sesiones comparten la misma cuota
+    return RateLimiter(rpm, tpm)
+
+def is_quota_error(e):
+    msg = f"{type(e).__name__} {e}".lower()
+    return any(k in msg for k in ("429", "quota", "resourceexhausted", "resource_exhausted", "rate limit"))
+
 # ==============================================================================
 # 3. BASE DE DATOS (ACTUALIZADA CON ESTADO DE PROCESO)
 # ==============================================================================
@@ -72,10 +134,21 @@ def init_db():
     c.execute('''CREATE TABLE IF NOT EXISTS analisis (
                     file_hash TEXT PRIMARY KEY, timestamp TEXT, lote_nombre TEXT, archivo_nombre TEXT,
                     candidato TEXT, facultad TEXT, cargo TEXT, puntaje REAL, recomendacion TEXT,
-                    ajuste TEXT, comentarios TEXT, raw_json TEXT, pdf_blob BLOB,
+                    ajuste TEXT, comentarios TEXT, raw_json TEXT,
                     facultad_filtro TEXT, cargo_filtro TEXT
                 )''')
     
+    # Informes PDF aparte: los listados nunca arrastran los blobs
+    c.execute('''CREATE TABLE IF NOT EXISTS informes (
+                    file_hash TEXT PRIMARY KEY,
+                    pdf_blob BLOB
+                )''')
+    
+    # Migración de BDs antiguas que guardaban pdf_blob dentro de 'analisis'
+    if 'pdf_blob' in [col[1] for col in c.execute("PRAGMA table_info(analisis)")]:
+        c.execute("INSERT OR IGNORE INTO informes SELECT file_hash, pdf_blob FROM analisis WHERE pdf_blob IS NOT NULL")
+        c.execute("ALTER TABLE analisis DROP COLUMN pdf_blob")
+    
     # Se agregó columna 'estado' para saber si terminó o falló
     c.execute('''CREATE TABLE IF NOT EXISTS batch_log (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -99,6 +172,26 @@ def init_db():
                     causa TEXT
                 )''')
     
+    # Cola persistente: el worker de fondo la consume aunque se cierre la pestaña
+    c.execute('''CREATE TABLE IF NOT EXISTS job_queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    batch_log_id INTEGER,
+                    lote_nombre TEXT,
+                    archivo_nombre TEXT,
+                    file_hash TEXT,
+                    file_bytes BLOB,
+                    facultad TEXT,
+                    cargo TEXT,
+                    modelo TEXT,
+                    api_key_id TEXT,
+                    estado TEXT,
+                    intentos INTEGER DEFAULT 0,
+                    causa TEXT,
+                    timestamp_creado TEXT,
+                    timestamp_inicio TEXT,
+                    timestamp_fin TEXT
+                )''')
+    
     conn.commit()
     return conn
 
@@ -121,11 +214,14 @@ def db_save_record(data_dict, pdf_bytes, file_hash, filename, lote_name, fac, ro
     comentarios = data_dict.get('conclusion_ejecutiva', 'Sin comentarios')
     
     # Guardamos también fac y rol como columnas explícitas para filtros
-    c.execute('''INSERT OR REPLACE INTO analisis VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+    c.execute('''INSERT OR REPLACE INTO analisis (file_hash, timestamp, lote_nombre, archivo_nombre, candidato, facultad, cargo,
+                                                  puntaje, recomendacion, ajuste, comentarios, raw_json, facultad_filtro, cargo_filtro)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
               (file_hash, now, lote_name, filename, 
                data_dict.get('nombre', 'Desconocido'),
                fac, rol, puntaje, data_dict.get('recomendacion', 'N/A'),
-               data_dict.get('ajuste', 'N/A'), comentarios, json_str, pdf_bytes, fac, rol))
+               data_dict.get('ajuste', 'N/A'), comentarios, json_str, fac, rol))
+    c.execute("INSERT OR REPLACE INTO informes (file_hash, pdf_blob) VALUES (?, ?)", (file_hash, pdf_bytes))
     conn.commit()
 
 def db_save_error(filename, lote_name, causa):
@@ -136,12 +232,12 @@ def db_save_error(filename, lote_name, causa):
     conn.commit()
 
 # --- Nuevas Funciones de Log de Lotes (Inicio y Fin separados) ---
-def db_log_start(mode, lote_name, total, fac, rol):
+def db_log_start(mode, lote_name, total, fac, rol, status_msg="En Progreso..."):
     c = conn.cursor()
     now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     c.execute('''INSERT INTO batch_log (timestamp_inicio, modo_ejecucion, lote_nombre, cantidad_total, facultad, cargo, estado)
                  VALUES (?, ?, ?, ?, ?, ?, ?)''',
-              (now, mode, lote_name, total, fac, rol, "En Progreso..."))
+              (now, mode, lote_name, total, fac, rol, status_msg))
     conn.commit()
     return c.lastrowid # Retornamos el ID para actualizarlo luego
 
@@ -160,8 +256,103 @@ def db_log_end(log_id, processed_count, status_msg, start_ts_float):
               (end_ts, dur_str, processed_count, status_msg, log_id))
     conn.commit()
 
-def db_load_all():
-    return pd.read_sql("SELECT * FROM analisis ORDER BY timestamp DESC", conn)
+def db_log_close_if_done(log_id):
+    # Cierra el lote cuando ya no le quedan trabajos pendientes en la cola
+    c = conn.cursor()
+    c.execute('''SELECT SUM(estado IN ('Pendiente', 'Procesando')), SUM(estado = 'Completado'), SUM(estado = 'Cancelado')
+                 FROM job_queue WHERE batch_log_id = ?''', (log_id,))
+    open_jobs, done, cancelled = c.fetchone()
+    if open_jobs: return False
+    c.execute("SELECT timestamp_inicio FROM batch_log WHERE id = ?", (log_id,))
+    start_ts = datetime.strptime(c.fetchone()[0], "%Y-%m-%d %H:%M:%S").timestamp()
+    db_log_end(log_id, done or 0, "Cancelado" if cancelled else "Finalizado Exitoso", start_ts)
+    return True
+
+# --- Cola de Trabajos ---
+def get_key_id(api_key):
+    # La API Key nunca se guarda en BD; los trabajos solo guardan su huella
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+def db_job_enqueue(log_id, lote_name, filename, file_hash, file_bytes, fac, rol, model_choice, key_id):
+    c = conn.cursor()
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    c.execute('''INSERT INTO job_queue (batch_log_id, lote_nombre, archivo_nombre, file_hash, file_bytes,
+                                        facultad, cargo, modelo, api_key_id, estado, timestamp_creado)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'Pendiente', ?)''',
+              (log_id, lote_name, filename, file_hash, file_bytes, fac, rol, model_choice, key_id, now))
+    conn.commit()
+
+def db_job_is_queued(file_hash):
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM job_queue WHERE file_hash = ? AND estado IN ('Pendiente', 'Procesando')", (file_hash,))
+    return c.fetchone() is not None
+
+def db_job_claim(key_ids, limit):
+    c = conn.cursor()
+    marks = ",".join("?" * len(key_ids))
+    c.execute(f'''SELECT id, batch_log_id, lote_nombre, archivo_nombre, file_hash, file_bytes, facultad, cargo, modelo, api_key_id
+                  FROM job_queue WHERE estado = 'Pendiente' AND api_key_id IN ({marks}) ORDER BY id LIMIT ?''',
+              (*key_ids, limit))
+    cols = [d[0] for d in c.description]
+    jobs = [dict(zip(cols, r)) for r in c.fetchall()]
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for job in jobs:
+        c.execute("UPDATE job_queue SET estado = 'Procesando', intentos = intentos + 1, timestamp_inicio = ? WHERE id = ?", (now, job['id']))
+        c.execute("UPDATE batch_log SET estado = 'En Progreso...' WHERE id = ? AND estado = 'En Cola'", (job['batch_log_id'],))
+    conn.commit()
+    return jobs
+
+def db_job_finish(job_id, status_msg, causa=None):
+    c = conn.cursor()
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Los bytes del archivo ya no hacen falta una vez resuelto el trabajo
+    c.execute("UPDATE job_queue SET estado = ?, causa = ?, timestamp_fin = ?, file_bytes = NULL WHERE id = ?",
+              (status_msg, causa, now, job_id))
+    conn.commit()
+
+def db_job_requeue_stale():
+    # Trabajos que quedaron 'Procesando' cuando se detuvo el servidor vuelven a la cola
+    conn.cursor().execute("UPDATE job_queue SET estado = 'Pendiente' WHERE estado = 'Procesando'")
+    conn.commit()
+
+def db_job_cancel(log_id):
+    conn.cursor().execute('''UPDATE job_queue SET estado = 'Cancelado', file_bytes = NULL
+                             WHERE batch_log_id = ? AND estado = 'Pendiente' ''', (log_id,))
+    conn.commit()
+    db_log_close_if_done(log_id)
+
+def db_job_counts(log_ids):
+    c = conn.cursor()
+    marks = ",".join("?" * len(log_ids))
+    c.execute(f"SELECT estado, COUNT(*) FROM job_queue WHERE batch_log_id IN ({marks}) GROUP BY estado", tuple(log_ids))
+    return dict(c.fetchall())
+
+def db_load_queue():
+    return pd.read_sql('''SELECT batch_log_id, lote_nombre, facultad, cargo,
+                                 SUM(estado = 'Pendiente') AS pendientes, SUM(estado = 'Procesando') AS procesando,
+                                 SUM(estado = 'Completado') AS completados, SUM(estado = 'Error') AS errores,
+                                 MIN(timestamp_creado) AS encolado
+                          FROM job_queue GROUP BY batch_log_id
+                          HAVING SUM(estado IN ('Pendiente', 'Procesando')) > 0
+                          ORDER BY batch_log_id''', conn)
+
+def db_load_all(columns=None):
+    # Cada vista pide solo las columnas que muestra (raw_json pesa)
+    cols = ", ".join(columns) if columns else "*"
+    return pd.read_sql(f"SELECT {cols} FROM analisis ORDER BY timestamp DESC", conn)
+
+def db_load_report(file_hash):
+    c = conn.cursor()
+    c.execute("SELECT pdf_blob FROM informes WHERE file_hash = ?", (file_hash,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+def db_iter_reports():
+    # Cursor en streaming: un blob en memoria a la vez
+    c = conn.cursor()
+    c.execute('''SELECT a.candidato, i.pdf_blob FROM analisis a JOIN informes i ON i.file_hash = a.file_hash
+                 WHERE i.pdf_blob IS NOT NULL ORDER BY a.timestamp DESC''')
+    yield from c
 
 def db_load_errors():
     return pd.read_sql("SELECT * FROM error_log ORDER BY timestamp DESC", conn)
@@ -185,7 +376,7 @@ def read_file_safe(file_obj):
         return ""
     except: return ""
 
-def analyze_with_gemini(text, role, faculty, api_key, model_choice):
+def analyze_with_gemini(text, role, faculty, api_key, model_choice, limiter=None, max_retries=5):
     if not api_key: return None
     genai.configure(api_key=api_key)
     
@@ -215,16 +406,24 @@ def analyze_with_gemini(text, role, faculty, api_key, model_choice):
     CV: {text[:30000]}
     """
     
-    try:
-        model = genai.GenerativeModel(model_choice)
-        response = model.generate_content(prompt)
-        raw = response.text
-        start = raw.find('{')
-        end = raw.rfind('}') + 1
-        return json.loads(raw[start:end]) if start != -1 else None
-    except Exception as e:
-        print(f"Error IA: {e}")
-        return None
+    est_tokens = len(prompt) // 4 + 1024  # Entrada aprox. + margen para la respuesta
+    model = genai.GenerativeModel(model_choice)
+    for attempt in range(max_retries + 1):
+        if limiter: limiter.acquire(est_tokens)
+        try:
+            response = model.generate_content(prompt)
+            if limiter: limiter.on_success()
+            raw = response.text
+            start = raw.find('{')
+            end = raw.rfind('}') + 1
+            return json.loads(raw[start:end]) if start != -1 else None
+        except Exception as e:
+            if is_quota_error(e) and attempt < max_retries:
+                if limiter: limiter.on_throttle()
+                else: time.sleep(2 ** attempt)
+                continue
+            print(f"Error IA: {e}")
+            return None
 
 # ==============================================================================
 # 5. GENERADOR PDF
@@ -298,112 +497,181 @@ def generate_pdf_report(data):
 # 6. LÓGICA DE PROCESAMIENTO (ROBUSTA CON TRY/EXCEPT Y LOGGING)
 # ==============================================================================
 
-def execute_processing(batches, api_key, model_choice, skip_dupes, delay_sec, is_massive):
-    total_files_global = sum(len(b['files']) for b in batches)
+def analyze_file(f_bytes, filename, batch, api_key, model_choice, limiter):
+    """Etapa concurrente: extracción + IA + informe. No toca la BD ni la UI (hilo de trabajo)."""
+    buf = io.BytesIO(f_bytes); buf.name = filename
+    text = read_file_safe(buf)
+    if len(text) < 50:
+        return None, "Archivo vacío/ilegible"
+    ai_res = analyze_with_gemini(text, batch['rol'], batch['fac'], api_key, model_choice, limiter)
+    if not ai_res:
+        return None, "Fallo IA"
+    ai_res.update({'facultad': batch['fac'], 'cargo': batch['rol']})
+    return (ai_res, generate_pdf_report(ai_res)), None
+
+class LiveFeed:
+    """Anillo en memoria con los últimos resultados guardados. El monitor en vivo lo lee
+    en vez de recargar 'analisis', así el costo por archivo no crece con la BD."""
+
+    def __init__(self, size=50):
+        self.rows = deque(maxlen=size)
+        self.seq = 0            # Crece con cada resultado; permite redibujar solo si hay novedades
+        self.lock = threading.Lock()
+
+    def push(self, row):
+        with self.lock:
+            self.rows.appendleft(row)
+            self.seq += 1
+
+    def snapshot(self, log_ids=None, n=5):
+        with self.lock:
+            rows = [r for r in self.rows if log_ids is None or r['batch_log_id'] in log_ids][:n]
+            return self.seq, rows
+
+class JobWorker:
+    """Hilo de fondo (uno por proceso del servidor) que consume job_queue con un pool de
+    hilos. No depende de ninguna sesión: cerrar la pestaña o hacer rerun no lo detiene."""
+
+    MAX_WORKERS = 16
+
+    def __init__(self):
+        self.keys = {}          # api_key_id -> (api_key, limiter); solo en memoria
+        self.workers = 4
+        self.feed = LiveFeed()
+        self.wake = threading.Event()
+        db_job_requeue_stale()
+        threading.Thread(target=self._run, name="cv-job-worker", daemon=True).start()
+
+    def register(self, api_key, workers, rpm, tpm):
+        # Cada rerun con API Key válida (re)habilita sus trabajos y actualiza límites
+        self.keys[get_key_id(api_key)] = (api_key, get_rate_limiter(api_key, rpm, tpm))
+        self.workers = min(workers, self.MAX_WORKERS)
+        self.wake.set()
+
+    def _run(self):
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as pool:
+            while True:
+                try:
+                    free = self.workers - len(running)
+                    if free > 0 and self.keys:
+                        for job in db_job_claim(list(self.keys), free):
+                            api_key, limiter = self.keys[job['api_key_id']]
+                            batch = {'fac': job['facultad'], 'rol': job['cargo']}
+                            fut = pool.submit(analyze_file, job['file_bytes'], job['archivo_nombre'], batch,
+                                              api_key, job['modelo'], limiter)
+                            running[fut] = job
+                    if not running:
+                        self.wake.wait(5); self.wake.clear()
+                        continue
+                    done, _ = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        self._finish(running.pop(fut), fut)
+                except Exception as e:
+                    print(f"Error Worker: {e}")
+                    time.sleep(5)
+
+    def _finish(self, job, fut):
+        try:
+            result, causa = fut.result()
+            if result:
+                ai_res, pdf = result
+                # Guardamos fac y rol explícitamente en BD
+                db_save_record(ai_res, pdf, job['file_hash'], job['archivo_nombre'], job['lote_nombre'], job['facultad'], job['cargo'])
+                db_job_finish(job['id'], "Completado")
+                self.feed.push({'batch_log_id': job['batch_log_id'], 'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                'lote_nombre': job['lote_nombre'], 'candidato': ai_res.get('nombre', 'Desconocido'),
+                                'puntaje': float(ai_res.get('puntaje_global', 0.0)), 'recomendacion': ai_res.get('recomendacion', 'N/A'),
+                                'comentarios': ai_res.get('conclusion_ejecutiva', 'Sin comentarios')})
+            else:
+                db_save_error(job['archivo_nombre'], job['lote_nombre'], causa)
+                db_job_finish(job['id'], "Error", causa)
+        except Exception as e:
+            db_save_error(job['archivo_nombre'], job['lote_nombre'], f"Error Sistema: {str(e)}")
+            db_job_finish(job['id'], "Error", str(e))
+        db_log_close_if_done(job['batch_log_id'])
+
+@st.cache_resource
+def get_job_worker():
+    return JobWorker()
+
+def execute_processing(batches, api_key, model_choice, skip_dupes, is_massive, refresh_sec=2):
+    key_id = get_key_id(api_key)
+    mode_str = "Masivo" if is_massive else "Individual"
+    log_ids = []
+    skipped_global = 0
+    queued_global = 0
+    seen_hashes = set()
     
-    est_sec_total = total_files_global * (delay_sec + 5)
-    est_min = est_sec_total // 60
-    st.info(f"⏱️ **Estimación Total:** {total_files_global} documentos. Tiempo aprox: {est_min} minutos. POR FAVOR NO CIERRE ESTA PESTAÑA.")
+    # 1. Encolar: hash + duplicados aquí; el análisis lo hace el worker de fondo
+    for batch in batches:
+        files_in_batch = len(batch['files'])
+        if files_in_batch == 0: continue
+        log_id = db_log_start(mode_str, batch['id'], files_in_batch, batch['fac'], batch['rol'], "En Cola")
+        log_ids.append(log_id)
+        for file in batch['files']:
+            file.seek(0); f_bytes = file.read(); f_hash = get_file_hash(f_bytes)
+            if skip_dupes and (f_hash in seen_hashes or db_check_exists(f_hash) or db_job_is_queued(f_hash)):
+                skipped_global += 1
+                continue
+            seen_hashes.add(f_hash)
+            db_job_enqueue(log_id, batch['id'], file.name, f_hash, f_bytes, batch['fac'], batch['rol'], model_choice, key_id)
+            queued_global += 1
+        db_log_close_if_done(log_id) # Lote compuesto solo de duplicados
+    worker = get_job_worker()
+    worker.wake.set()
     
+    st.info(f"📨 **En Cola:** {queued_global} documentos (saltados: {skipped_global}). Puede cerrar esta pestaña: el procesamiento continúa en segundo plano; siga el avance en 📜 Historial Lotes.")
+    if not queued_global:
+        return
+    
+    # 2. Monitor (opcional): solo consulta el estado de la cola
     progress_bar = st.progress(0, "Iniciando...")
     status = st.empty()
     st.subheader("📋 Datos en Vivo (Streaming)")
     live_table = st.empty()
-    
-    processed_global = 0
-    skipped_global = 0
-    errors_global = 0
-    current_idx_global = 0
     start_time_global = time.time()
+    last_seq = -1
     
-    # --- Try/Except Global para atrapar interrupciones ---
     try:
-        for batch in batches:
-            files_in_batch = len(batch['files'])
-            if files_in_batch == 0: continue
-
-            # 1. Registrar Inicio del Lote en BD
-            start_time_batch = time.time()
-            mode_str = "Masivo" if is_massive else "Individual"
-            log_id = db_log_start(mode_str, batch['id'], files_in_batch, batch['fac'], batch['rol'])
+        while True:
+            counts = db_job_counts(log_ids)
+            open_jobs = counts.get('Pendiente', 0) + counts.get('Procesando', 0)
+            done = queued_global - open_jobs
             
-            processed_in_batch = 0 # Contador local para el log
+            # Timer
+            elapsed = time.time() - start_time_global
+            avg_time = elapsed / done if done > 0 else 0
+            remaining = avg_time * open_jobs
+            m_elap, s_elap = divmod(int(elapsed), 60)
+            m_rem, s_rem = divmod(int(remaining), 60)
             
-            for file in batch['files']:
-                current_idx_global += 1
-                
-                # Timer
-                elapsed = time.time() - start_time_global
-                avg_time = elapsed / current_idx_global if current_idx_global > 0 else 0
-                remaining = avg_time * (total_files_global - current_idx_global)
-                m_elap, s_elap = divmod(int(elapsed), 60)
-                m_rem, s_rem = divmod(int(remaining), 60)
-                
-                status.markdown(f"""
-                **Procesando:** `{file.name}` ({batch['id']})  
-                ⏳ **Transcurrido:** {m_elap:02d}:{s_elap:02d} | 🏁 **Restante:** {m_rem:02d}:{s_rem:02d}
-                """)
-                
-                try:
-                    # 1. Hash & Check
-                    file.seek(0); f_bytes = file.read(); f_hash = get_file_hash(f_bytes)
-                    
-                    if skip_dupes and db_check_exists(f_hash):
-                        skipped_global += 1
-                    else:
-                        # 2. Análisis
-                        file.seek(0)
-                        text = read_file_safe(file)
-                        
-                        if len(text) < 50:
-                            errors_global += 1
-                            db_save_error(file.name, batch['id'], "Archivo vacío/ilegible")
-                        else:
-                            ai_res = analyze_with_gemini(text, batch['rol'], batch['fac'], api_key, model_choice)
-                            if ai_res:
-                                ai_res.update({'facultad': batch['fac'], 'cargo': batch['rol']})
-                                pdf = generate_pdf_report(ai_res)
-                                # Guardamos fac y rol explícitamente en BD
-                                db_save_record(ai_res, pdf, f_hash, file.name, batch['id'], batch['fac'], batch['rol'])
-                                processed_global += 1
-                                processed_in_batch += 1
-                            else: 
-                                errors_global += 1
-                                db_save_error(file.name, batch['id'], "Fallo IA")
-                        
-                        # 3. Rate Limit
-                        time.sleep(delay_sec)
-                
-                except Exception as e:
-                    errors_global += 1
-                    db_save_error(file.name, batch['id'], f"Error Sistema: {str(e)}")
-                
-                # UI Update
-                progress_bar.progress(current_idx_global / total_files_global)
-                
-                if current_idx_global % 1 == 0:
-                    with live_table.container():
-                        df = db_load_all()
-                        if not df.empty:
-                            st.dataframe(
-                                df[['timestamp', 'lote_nombre', 'candidato', 'puntaje', 'recomendacion', 'comentarios']].head(5),
-                                column_config={
-                                    "puntaje": st.column_config.ProgressColumn("Puntaje", format="%.2f", min_value=0, max_value=5),
-                                    "comentarios": st.column_config.TextColumn("Resumen", width="large")
-                                }, use_container_width=True, hide_index=True
-                            )
+            status.markdown(f"""
+            **En curso:** {counts.get('Procesando', 0)} · **Pendientes:** {counts.get('Pendiente', 0)} · **Errores:** {counts.get('Error', 0)}  
+            ⏳ **Transcurrido:** {m_elap:02d}:{s_elap:02d} | 🏁 **Restante:** {m_rem:02d}:{s_rem:02d}
+            """)
+            progress_bar.progress(done / queued_global)
             
-            # 4. Cerrar Log del Lote (Éxito)
-            db_log_end(log_id, processed_in_batch, "Finalizado Exitoso", start_time_batch)
-
-        status.success(f"Finalizado. Nuevos: {processed_global} | Saltados: {skipped_global} | Errores: {errors_global}")
+            # Tabla en vivo desde el anillo en memoria; solo se redibuja si llegó algo nuevo
+            seq, rows = worker.feed.snapshot(log_ids)
+            if seq != last_seq:
+                last_seq = seq
+                with live_table.container():
+                    if rows:
+                        st.dataframe(
+                            pd.DataFrame(rows)[['timestamp', 'lote_nombre', 'candidato', 'puntaje', 'recomendacion', 'comentarios']],
+                            column_config={
+                                "puntaje": st.column_config.ProgressColumn("Puntaje", format="%.2f", min_value=0, max_value=5),
+                                "comentarios": st.column_config.TextColumn("Resumen", width="large")
+                            }, use_container_width=True, hide_index=True
+                        )
+            if open_jobs == 0: break
+            time.sleep(refresh_sec)
+        
+        status.success(f"Finalizado. Nuevos: {counts.get('Completado', 0)} | Saltados: {skipped_global} | Errores: {counts.get('Error', 0)}")
     
     except Exception as e:
-        st.error(f"⚠️ El proceso se interrumpió inesperadamente: {str(e)}")
-        # Intentar cerrar el log si quedó abierto
-        try:
-            db_log_end(log_id, processed_in_batch, "Interrumpido / Error", start_time_batch)
-        except: pass
+        st.error(f"⚠️ El monitor se interrumpió ({str(e)}); el procesamiento continúa en segundo plano.")
     
     finally:
         time.sleep(2)
@@ -440,14 +708,20 @@ with st.sidebar:
         st.warning("Ingrese API Key.")
         model_choice = None
         
-    delay = st.slider("Pausa entre CVs (seg)", 2, 20, 5, help="Más alto = Menos riesgo de bloqueo.")
+    workers = st.slider("CVs en paralelo", 1, 16, 4, help="Llamadas simultáneas a Gemini.")
+    rpm = st.number_input("Solicitudes por minuto (RPM)", 1, 10000, 15, help="Cuota del plan. Ante un 429 el ritmo se reduce solo.")
+    tpm = st.number_input("Tokens por minuto (TPM)", 1000, 10_000_000, 1_000_000, step=1000)
+    if api_key: get_job_worker().register(api_key, workers, rpm, tpm)
     
     st.divider()
     skip_dupes = st.checkbox("Omitir Duplicados", value=True)
+    refresh_sec = st.slider("Refresco en vivo (seg)", 1, 30, 2, help="Cada cuánto se actualiza el monitor de avance.")
     if st.button("🗑️ Reset Total"):
         conn.cursor().execute("DELETE FROM analisis")
+        conn.cursor().execute("DELETE FROM informes")
         conn.cursor().execute("DELETE FROM batch_log")
         conn.cursor().execute("DELETE FROM error_log")
+        conn.cursor().execute("DELETE FROM job_queue")
         conn.commit()
         st.rerun()
 
@@ -475,7 +749,7 @@ with tab1:
             
             if st.button(f"▶ Procesar Lote {idx}", key=f"b{idx}"):
                 if api_key and model_choice and files:
-                    execute_processing([{'id': f"Lote {idx}", 'files': files, 'fac': fac, 'rol': rol}], api_key, model_choice, skip_dupes, delay, False)
+                    execute_processing([{'id': f"Lote {idx}", 'files': files, 'fac': fac, 'rol': rol}], api_key, model_choice, skip_dupes, False, refresh_sec)
                 else: st.error("Verifique Configuración")
             
             if files: batches_data.append({'id': f"Lote {idx}", 'files': files, 'fac': fac, 'rol': rol})
@@ -486,13 +760,13 @@ with tab1:
     st.markdown("---")
     if st.button("🚀 PROCESAR TODO", type="primary", use_container_width=True):
         if api_key and model_choice and batches_data:
-            execute_processing(batches_data, api_key, model_choice, skip_dupes, delay, True)
+            execute_processing(batches_data, api_key, model_choice, skip_dupes, True, refresh_sec)
         else: st.error("Faltan datos o API Key")
 
 # --- TAB 2: DASHBOARD ---
 with tab2:
     st.header("📊 Analytics")
-    df = db_load_all()
+    df = db_load_all(['facultad', 'puntaje', 'recomendacion'])
     df_err = db_load_errors()
     
     if not df.empty or not df_err.empty:
@@ -513,7 +787,8 @@ with tab2:
 # --- TAB 3: DATOS ---
 with tab3:
     st.header("🗃️ Base de Datos")
-    df = db_load_all()
+    df = db_load_all(['file_hash', 'timestamp', 'lote_nombre', 'archivo_nombre', 'candidato', 'facultad', 'cargo',
+                      'puntaje', 'recomendacion', 'ajuste', 'comentarios', 'facultad_filtro', 'cargo_filtro'])
     df_err = db_load_errors()
     
     if not df.empty:
@@ -528,7 +803,7 @@ with tab3:
         
         buffer = io.BytesIO()
         with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            df.drop(columns=['pdf_blob', 'raw_json']).to_excel(writer, index=False, sheet_name='Resultados')
+            df.to_excel(writer, index=False, sheet_name='Resultados')
             if not df_err.empty: df_err.to_excel(writer, index=False, sheet_name='Errores')
                 
         st.download_button("💾 Descargar Excel", buffer.getvalue(), "Reporte_HR.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
@@ -541,22 +816,36 @@ with tab3:
 # --- TAB 4: REPOSITORIO ---
 with tab4:
     st.header("📂 Informes")
-    df = db_load_all()
+    df = db_load_all(['file_hash', 'candidato', 'puntaje'])
     if not df.empty:
         zip_mem = io.BytesIO()
         with zipfile.ZipFile(zip_mem, "w") as zf:
-            for i, r in df.iterrows():
-                if r['pdf_blob']: zf.writestr(f"{re.sub(r'[^a-zA-Z0-9]', '_', str(r['candidato']))}.pdf", r['pdf_blob'])
+            for candidato, blob in db_iter_reports():
+                zf.writestr(f"{re.sub(r'[^a-zA-Z0-9]', '_', str(candidato))}.pdf", blob)
         st.download_button("📦 Descargar ZIP", zip_mem.getvalue(), "Informes.zip", type="primary")
         
         for i, r in df.iterrows():
             with st.expander(f"{r['candidato']} ({r['puntaje']})"):
-                if r['pdf_blob']: st.download_button("PDF", r['pdf_blob'], f"{r['candidato']}.pdf", key=f"d{i}")
+                # El blob se lee de BD solo al pulsar el botón
+                st.download_button("PDF", lambda h=r['file_hash']: db_load_report(h), f"{r['candidato']}.pdf",
+                                   "application/pdf", key=f"d{i}")
     else: st.info("Sin informes.")
 
 # --- TAB 5: REGISTRO (NUEVA) ---
+@st.fragment(run_every=5)
+def render_queue_status():
+    df_q = db_load_queue()
+    if df_q.empty: return
+    st.subheader("⏳ Cola de Trabajos")
+    st.dataframe(df_q, use_container_width=True, hide_index=True)
+    for _, r in df_q.iterrows():
+        if st.button(f"⏹️ Cancelar pendientes de {r['lote_nombre']} (#{r['batch_log_id']})", key=f"cancel{r['batch_log_id']}"):
+            db_job_cancel(int(r['batch_log_id']))
+            st.rerun()
+
 with tab5:
     st.header("📜 Historial de Lotes")
+    render_queue_status()
     df_logs = db_load_logs()
     if df_logs.empty:
         st.info("Sin historial.")